@@ -1,16 +1,26 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer
 from pydantic import BaseModel
 from typing import List
+import asyncio
+import msgspec
+import orjson
 import uuid
 import datetime
 from dotenv import load_dotenv
 import os
+import sys
 import uvicorn
 
-from utils.cosmos_connection import cosmos_enabled, save_message_to_cosmos, get_last_messages_from_cosmos
-from utils.llm_invoke import call_llm_async_with_retry, warm_up_search_index
+from utils import cosmos_connection
+from utils.history_cache import close_history_cache
+from utils.cosmos_connection import init_cosmos, close_cosmos, save_message_to_cosmos, get_last_messages_from_cosmos, \
+    get_session_messages_from_cosmos
+from utils.llm_invoke import call_llm_async_with_retry, stream_llm_response, warm_up_search_index, close_llm_client, \
+    init_tokenizer, llm_limiter_stats
 from utils.log_utils import logger
 
 load_dotenv()
@@ -19,12 +29,45 @@ load_dotenv()
 allowed_origins = os.getenv("ALLOWED_ORIGINS", "*")
 allowed_origins_list = [origin.strip() for origin in allowed_origins.split(",") if origin.strip()]
 
+# Strong references to fire-and-forget tasks so they are not garbage collected mid-flight
+background_tasks: set = set()
+
+
+def run_in_background(coro):
+    """Schedule a coroutine without awaiting it, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_cosmos()
+    # May download the encoding, so it loads in the background; prompts are estimated until it is ready
+    run_in_background(init_tokenizer())
+    # Warm the search index once per process rather than on every request
+    if await warm_up_search_index():
+        logger.info("Search index warmup completed successfully")
+    else:
+        logger.warning("Search index warmup did not complete successfully")
+    yield
+    # Let pending Cosmos writes finish before closing the client
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    await close_cosmos()
+    await close_history_cache()
+    await close_llm_client()
+
+
 app = FastAPI(
     title="AZURE AI CHATBOT API",
     version="0.0.1",
     description="API for Azure AI Chatbot with Cosmos DB integration",
     docs_url="/docs",
     redoc_url="/redoc",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # CORS configuration
@@ -40,13 +83,7 @@ app.add_middleware(
 security = HTTPBearer()
 
 
-# Pydantic models
-class ChatMessage(BaseModel):
-    role: str
-    content: str
-    timestamp: datetime.datetime
-
-
+# Pydantic models (request validation)
 class ChatRequest(BaseModel):
     message: str
     session_id: str
@@ -54,25 +91,43 @@ class ChatRequest(BaseModel):
     user_roles: List[str] = []
 
 
-class ChatResponse(BaseModel):
+# msgspec structs (response encoding)
+class ChatMessage(msgspec.Struct):
+    role: str
+    content: str
+    # Naive UTC ISO-8601
+    timestamp: str
+
+
+class ChatResponse(msgspec.Struct):
     response: str
     session_id: str
 
 
-class SessionInfo(BaseModel):
+class SessionInfo(msgspec.Struct):
     session_id: str
     cosmos_enabled: bool
     message_count: int
 
 
-class MessageHistory(BaseModel):
+class MessageHistory(msgspec.Struct):
     messages: List[ChatMessage]
     session_id: str
 
 
+def msgspec_response(content) -> Response:
+    """Encode a response body with msgspec, bypassing FastAPI's response model serialization"""
+    return Response(content=msgspec.json.encode(content), media_type="application/json")
+
+
 # API Endpoints
 @app.get("/")
 async def root():
+    return {"status": "ok"}
+
+
+@app.get("/warm-up")
+async def warm_up():
     try:
         success = await warm_up_search_index()
         if success:
@@ -80,8 +135,8 @@ async def root():
             return {
                 "message": "Search index warmup completed successfully",
                 "status": "healthy",
-                "cosmos_enabled": cosmos_enabled,
-                "timestamp": datetime.datetime.utcnow().isoformat(),
+                "cosmos_enabled": cosmos_connection.cosmos_enabled,
+                "timestamp": datetime.datetime.utcnow(),
                 "success": True
             }
         else:
@@ -89,8 +144,8 @@ async def root():
             return {
                 "message": "Search index warmup did not complete successfully",
                 "status": "healthy",
-                "cosmos_enabled": cosmos_enabled,
-                "timestamp": datetime.datetime.utcnow().isoformat(),
+                "cosmos_enabled": cosmos_connection.cosmos_enabled,
+                "timestamp": datetime.datetime.utcnow(),
                 "success": False
             }
     except Exception as e:
@@ -98,6 +153,11 @@ async def root():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/metrics")
+async def metrics():
+    return {"llm_limiter": dict(llm_limiter_stats)}
+
+
 @app.get("/session/new")
 async def create_new_session():
     new_session_id = str(uuid.uuid4())
@@ -108,37 +168,88 @@ async def create_new_session():
 async def get_session_history(user_id: str):
     try:
         messages = []
-        if cosmos_enabled:
-            messages = get_last_messages_from_cosmos(user_id=user_id)
-        return messages
+        if cosmos_connection.cosmos_enabled:
+            messages = await get_last_messages_from_cosmos(user_id=user_id)
+        return msgspec_response(messages)
     except Exception as e:
         logger.error(f"Session history error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/chat", response_model=ChatResponse)
+async def prepare_chat(request: ChatRequest):
+    """Save the user message and return the session history to send with it"""
+    # Read before saving: a cold history cache is filled from Cosmos DB first, so the save's push
+    # then lands on the filled list. Saving only queues the Cosmos DB write, so this costs little.
+    history = await get_session_messages_from_cosmos(request.session_id, limit=5)
+    await save_message_to_cosmos(session_id=request.session_id, user_id=request.user_id,
+                                 user_roles=request.user_roles, role="user", content=request.message)
+    return history
+
+
+def sse_event(data: dict, event: str = None):
+    """Format a server-sent event"""
+    payload = f"data: {orjson.dumps(data).decode()}\n\n"
+    return f"event: {event}\n{payload}" if event else payload
+
+
+@app.post("/chat")
 async def chat(request: ChatRequest):
+    """Stream the AI response as server-sent events, one `delta` per chunk"""
+    history = await prepare_chat(request)
+
+    async def event_generator():
+        buf = []
+        error_message = None
+        try:
+            async for delta in stream_llm_response(request.message, request.session_id, history=history):
+                buf.append(delta)
+                yield sse_event({"delta": delta})
+            yield sse_event({"session_id": request.session_id}, event="done")
+        except Exception as e:
+            logger.error(f"Chat stream error: {str(e)}")
+            error_message = f"Error: {str(e)}"
+            yield sse_event({"detail": error_message}, event="error")
+        finally:
+            # Save whatever was produced, even if the client disconnected mid-stream
+            if error_message:
+                run_in_background(save_message_to_cosmos(session_id=request.session_id, user_id=request.user_id,
+                                                         user_roles=request.user_roles, role="error",
+                                                         content=error_message))
+            elif buf:
+                run_in_background(save_message_to_cosmos(session_id=request.session_id, user_id=request.user_id,
+                                                         user_roles=request.user_roles, role="assistant",
+                                                         content="".join(buf)))
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/chat/sync", response_class=Response)
+async def chat_sync(request: ChatRequest):
+    """Non-streaming chat for clients that need the whole response in one JSON body"""
     try:
-        # Save user message to Cosmos DB
-        save_message_to_cosmos(session_id=request.session_id, user_id=request.user_id, user_roles=request.user_roles,
-                               role="user", content=request.message)
+        history = await prepare_chat(request)
 
         # Get AI response
-        response = await call_llm_async_with_retry(request.message, request.session_id)
+        response = await call_llm_async_with_retry(request.message, request.session_id, history=history)
 
-        # Save AI response to Cosmos DB
-        save_message_to_cosmos(session_id=request.session_id, user_id=request.user_id, user_roles=request.user_roles,
-                               role="assistant", content=response)
+        # Save AI response to Cosmos DB without holding up the HTTP response
+        run_in_background(save_message_to_cosmos(session_id=request.session_id, user_id=request.user_id,
+                                                 user_roles=request.user_roles, role="assistant",
+                                                 content=response))
 
-        return ChatResponse(response=response, session_id=request.session_id)
+        return msgspec_response(ChatResponse(response=response, session_id=request.session_id))
 
     except Exception as e:
         logger.error(f"Chat error: {str(e)}")
         error_message = f"Error: {str(e)}"
-        save_message_to_cosmos(session_id=request.session_id, user_id=request.user_id, user_roles=request.user_roles,
-                               role="error", content=error_message)
+        run_in_background(save_message_to_cosmos(session_id=request.session_id, user_id=request.user_id,
+                                                 user_roles=request.user_roles, role="error",
+                                                 content=error_message))
         raise HTTPException(status_code=500, detail=error_message)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop has no Windows build, so Windows falls back to the default asyncio loop
+    uvicorn.run("app:app", host="0.0.0.0", port=8000, loop="asyncio" if sys.platform == "win32" else "uvloop",
+                http="httptools", workers=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))))
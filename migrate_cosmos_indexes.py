@@ -0,0 +1,58 @@
+"""
+One-off migration adding the composite indexes the history queries rely on to the chat container.
+Run once per container with `python migrate_cosmos_indexes.py`, not on app startup.
+"""
+import asyncio
+
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient
+
+from utils.cosmos_connection import COSMOS_CONNECTION_STRING, COSMOS_DB_NAME, COSMOS_CONTAINER_NAME, \
+    COMPOSITE_INDEXES
+from utils.log_utils import logger
+
+# replace_container resets any container setting it is not given, so these are carried over as they are
+PRESERVED_SETTINGS = {
+    "defaultTtl": "default_ttl",
+    "conflictResolutionPolicy": "conflict_resolution_policy",
+    "analyticalStorageTtl": "analytical_storage_ttl",
+    "computedProperties": "computed_properties",
+    "fullTextPolicy": "full_text_policy",
+    "vectorEmbeddingPolicy": "vector_embedding_policy",
+}
+
+
+async def add_composite_indexes():
+    """Add any missing COMPOSITE_INDEXES to the container's indexing policy"""
+    async with CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING) as cosmos_client:
+        database = cosmos_client.get_database_client(COSMOS_DB_NAME)
+        container = database.get_container_client(COSMOS_CONTAINER_NAME)
+        properties = await container.read()
+
+        partition_key = properties["partitionKey"]
+        if partition_key["paths"] != ["/session_id"]:
+            logger.warning(f"Container is partitioned on {partition_key['paths']}, not /session_id; "
+                           "session history queries will run across partitions")
+
+        indexing_policy = properties.get("indexingPolicy", {})
+        composite_indexes = indexing_policy.get("compositeIndexes", [])
+        missing = [index for index in COMPOSITE_INDEXES if index not in composite_indexes]
+        if not missing:
+            logger.info("Composite indexes already present, nothing to do")
+            return
+
+        indexing_policy["compositeIndexes"] = composite_indexes + missing
+        preserved = {kwarg: properties[setting] for setting, kwarg in PRESERVED_SETTINGS.items()
+                     if setting in properties}
+        await database.replace_container(
+            container,
+            partition_key=PartitionKey(path=partition_key["paths"][0], kind=partition_key.get("kind", "Hash"),
+                                       version=partition_key.get("version", 2)),
+            indexing_policy=indexing_policy,
+            **preserved
+        )
+        logger.info(f"Added {len(missing)} composite indexes to Cosmos DB container {COSMOS_CONTAINER_NAME}")
+
+
+if __name__ == "__main__":
+    asyncio.run(add_composite_indexes())
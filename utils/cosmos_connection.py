@@ -1,11 +1,14 @@
+import asyncio
 import datetime
 import os
+import time
 from functools import partial
 
 from dotenv import load_dotenv
 import uuid
-from azure.cosmos import CosmosClient
+from azure.cosmos.aio import CosmosClient
 
+from utils.history_cache import get_cached_messages, fill_history_cache, push_message_to_cache
 from utils.log_utils import logger, debug_print
 load_dotenv()
 
@@ -13,56 +16,180 @@ COSMOS_CONNECTION_STRING = os.getenv("COSMOS_CONNECTION_STRING")
 COSMOS_DB_NAME = os.getenv("COSMOS_DB_NAME")
 COSMOS_CONTAINER_NAME = os.getenv("COSMOS_CONTAINER_NAME")
 
-# Initialize Cosmos DB client
-try:
-    cosmos_client = CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
-    database = cosmos_client.get_database_client(COSMOS_DB_NAME)
-    container = database.get_container_client(COSMOS_CONTAINER_NAME)
-    cosmos_enabled = True
-    logger.info("Cosmos DB connection established successfully")
-except Exception as e:
-    logger.error(f"Cosmos DB connection failed: {str(e)}")
+# Message roles that make up the conversation history sent to the LLM
+HISTORY_ROLES = ("user", "assistant")
+
+# Synthetic sessions, such as the search index warm-up, that never have history to read or save
+WARMUP_SESSION_ID = "warmup-session"
+NO_HISTORY_SESSIONS = frozenset({WARMUP_SESSION_ID})
+
+# Writes are queued and flushed as transactional batches grouped by session (one partition per batch)
+COSMOS_BATCH_SIZE = 32
+COSMOS_BATCH_WINDOW = 0.02
+
+# Composite indexes letting the history queries read their ORDER BY straight from the index; each query
+# orders by its equality-filtered property first so its ORDER BY matches one of these exactly.
+# Applied once with `python migrate_cosmos_indexes.py`
+COMPOSITE_INDEXES = [
+    # get_session_messages_from_cosmos
+    [{"path": "/session_id", "order": "ascending"}, {"path": "/timestamp", "order": "descending"}],
+    # get_session_messages_from_cosmos, legacy ISO-8601 timestamp top-up
+    [{"path": "/session_id", "order": "ascending"}, {"path": "/_ts", "order": "descending"}],
+    # get_latest_session_ids
+    [{"path": "/user_id", "order": "ascending"}, {"path": "/_ts", "order": "descending"}],
+]
+
+cosmos_client = None
+container = None
+cosmos_enabled = False
+# Whether the container is partitioned on /session_id, which batched writes and session-scoped queries need
+session_partitioned = False
+write_queue: asyncio.Queue = asyncio.Queue()
+writer_task = None
+
+
+def timestamp_ns(value):
+    """Message timestamp as epoch nanoseconds, converting legacy ISO-8601 (UTC) strings"""
+    if isinstance(value, str):
+        parsed = datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc)
+        return int(parsed.timestamp() * 1_000_000_000)
+    return value
+
+
+def timestamp_iso(value):
+    """Message timestamp as a naive UTC ISO-8601 string, the format used before epoch nanoseconds"""
+    if isinstance(value, str):
+        return value
+    return (datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=value // 1000)).isoformat()
+
+
+async def init_cosmos():
+    """Initialize the async Cosmos DB client, called once on app startup"""
+    global cosmos_client, container, cosmos_enabled, session_partitioned, writer_task
+    try:
+        cosmos_client = CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
+        database = cosmos_client.get_database_client(COSMOS_DB_NAME)
+        container = database.get_container_client(COSMOS_CONTAINER_NAME)
+        properties = await container.read()
+        partition_paths = properties["partitionKey"]["paths"]
+        session_partitioned = partition_paths == ["/session_id"]
+        if not session_partitioned:
+            logger.warning(f"Cosmos DB container is partitioned on {partition_paths}, not /session_id; "
+                           "writing messages individually and querying history across partitions")
+        cosmos_enabled = True
+        writer_task = asyncio.create_task(_cosmos_writer())
+        logger.info("Cosmos DB connection established successfully")
+    except Exception as e:
+        logger.error(f"Cosmos DB connection failed: {str(e)}")
+        cosmos_enabled = False
+
+
+async def close_cosmos():
+    """Flush queued writes and close the async Cosmos DB client, called once on app shutdown"""
+    global cosmos_client, container, cosmos_enabled, writer_task
     cosmos_enabled = False
+    if writer_task is not None:
+        # None tells the writer to flush what is queued and stop
+        await write_queue.put(None)
+        await writer_task
+        writer_task = None
+    container = None
+    if cosmos_client is not None:
+        await cosmos_client.close()
+        cosmos_client = None
+        logger.info("Cosmos DB connection closed")
+
+
+async def _write_batch(items: list):
+    """Write queued items, as one transactional batch per session when the container allows it"""
+    if not session_partitioned:
+        # A batch needs one partition key value; messages of a session only share one under /session_id
+        for item in items:
+            try:
+                await container.create_item(body=item)
+            except Exception as e:
+                logger.error(f"Failed to save message to Cosmos DB for session {item['session_id']}: {str(e)}")
+        debug_print(f"Saved {len(items)} messages to Cosmos DB individually")
+        return
+
+    batches = {}
+    for item in items:
+        batches.setdefault(item["session_id"], []).append(item)
+
+    for session_id, session_items in batches.items():
+        try:
+            await container.execute_item_batch(
+                batch_operations=[("create", (item,)) for item in session_items],
+                partition_key=session_id
+            )
+            debug_print(f"Saved {len(session_items)} messages to Cosmos DB for session {session_id}")
+        except Exception as e:
+            logger.error(f"Failed to save {len(session_items)} messages to Cosmos DB for session {session_id}: {str(e)}")
+
+
+async def _cosmos_writer():
+    """Drain the write queue, collecting items for up to COSMOS_BATCH_WINDOW seconds per batch"""
+    while True:
+        items = [await write_queue.get()]
+        if items[0] is not None:
+            await asyncio.sleep(COSMOS_BATCH_WINDOW)
+            try:
+                while len(items) < COSMOS_BATCH_SIZE and items[-1] is not None:
+                    items.append(write_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                pass
+
+        stopping = items[-1] is None
+        items = [item for item in items if item is not None]
+        if items:
+            await _write_batch(items)
+        if stopping:
+            return
 
 
-def save_message_to_cosmos(session_id: str, user_id:str, user_roles:list[str], role: str, content: str):
-    """Save a message to Cosmos DB"""
+async def save_message_to_cosmos(session_id: str, user_id:str, user_roles:list[str], role: str, content: str):
+    """Queue a message for Cosmos DB and add it to the history cache"""
+    if session_id in NO_HISTORY_SESSIONS:
+        return
+    item = {
+        "id": str(uuid.uuid4()),
+        "session_id": session_id,
+        "user_id": user_id,
+        "userRoles": user_roles,
+        "timestamp": time.time_ns(),
+        "role": role,
+        "content": content
+    }
+    if role in HISTORY_ROLES:
+        await push_message_to_cache(session_id, {
+            "role": role,
+            "content": content,
+            "timestamp": item["timestamp"]
+        })
+
     if not cosmos_enabled:
         debug_print("Cosmos DB not enabled, skipping message save")
         return
-    try:
-        item = {
-            "id": str(uuid.uuid4()),
-            "session_id": session_id,
-            "user_id": user_id,
-            "userRoles": user_roles,
-            "timestamp": datetime.datetime.utcnow().isoformat(),
-            "role": role,
-            "content": content
-        }
-        container.create_item(body=item)
-        debug_print(f"Message saved to Cosmos DB", {"role": role, "content_length": len(content)})
-    except Exception as e:
-        debug_print(f"Failed to save message to Cosmos DB: {str(e)}")
+    await write_queue.put(item)
+    debug_print(f"Message queued for Cosmos DB", {"role": role, "content_length": len(content)})
 
 
-def get_latest_session_ids(user_id: str, limit: int = 5):
+async def get_latest_session_ids(user_id: str, limit: int = 5):
     if not cosmos_enabled:
         debug_print("Cosmos DB not enabled, returning None for session ID")
         return None
     try:
         query = """
-        SELECT c.session_id, c.timestamp FROM c
+        SELECT c.session_id, c._ts FROM c
         WHERE c.user_id = @user_id
-        ORDER BY c.timestamp DESC
+        ORDER BY c.user_id ASC, c._ts DESC
         """
         parameters = [{"name": "@user_id", "value": user_id}]
 
-        items = list(container.query_items(
+        items = [item async for item in container.query_items(
             query=query,
-            parameters=parameters,
-            enable_cross_partition_query=True
-        ))
+            parameters=parameters
+        )]
 
         # Deduplicate and limit
         seen = set()
@@ -82,13 +209,13 @@ def get_latest_session_ids(user_id: str, limit: int = 5):
         return None
 
 
-def get_last_messages_from_cosmos(user_id: str, limit: int = 5):
+async def get_last_messages_from_cosmos(user_id: str, limit: int = 5):
     """Fetch last N messages per session from Cosmos DB"""
     if not cosmos_enabled:
         debug_print("Cosmos DB not enabled, returning empty context")
         return []
 
-    session_ids = get_latest_session_ids(user_id=user_id, limit=limit)
+    session_ids = await get_latest_session_ids(user_id=user_id, limit=limit)
     if not session_ids:
         debug_print("No session IDs found, returning empty context")
         return []
@@ -105,13 +232,15 @@ def get_last_messages_from_cosmos(user_id: str, limit: int = 5):
                 {"name": "@user_id", "value": user_id},
                 {"name": "@session_id", "value": session_id}
             ]
-            items = list(container.query_items(
+            items = [item async for item in container.query_items(
                 query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
+                parameters=parameters
+            )]
 
-            sorted_items = sorted(items, key=lambda x: x["timestamp"])
+            sorted_items = sorted(items, key=lambda x: timestamp_ns(x["timestamp"]))
+            # API clients get one timestamp format whichever way the message was stored
+            for item in sorted_items:
+                item["timestamp"] = timestamp_iso(item["timestamp"])
             debug_print(f"Retrieved {len(sorted_items)} messages from Cosmos DB for session {session_id}")
 
             # Append a dict for each session
@@ -125,3 +254,58 @@ def get_last_messages_from_cosmos(user_id: str, limit: int = 5):
             continue
 
     return messages
+
+
+async def get_session_messages_from_cosmos(session_id: str, limit: int = 5):
+    """Fetch the last N chat messages of a session, oldest first, from the history cache or Cosmos DB"""
+    cached_messages = await get_cached_messages(session_id, limit=limit)
+    if cached_messages is not None:
+        return cached_messages
+
+    if not cosmos_enabled:
+        debug_print("Cosmos DB not enabled, returning empty history")
+        return []
+    try:
+        parameters = [
+            {"name": "@session_id", "value": session_id},
+            {"name": "@limit", "value": limit}
+        ]
+        # Single-partition query when the container is partitioned on /session_id
+        query_options = {"partition_key": session_id} if session_partitioned else {}
+        query = """
+        SELECT c.role, c.content, c["timestamp"] FROM c
+        WHERE c.session_id = @session_id AND c.role IN ("user", "assistant") AND IS_NUMBER(c["timestamp"])
+        ORDER BY c.session_id ASC, c["timestamp"] DESC
+        OFFSET 0 LIMIT @limit
+        """
+        items = [item async for item in container.query_items(
+            query=query,
+            parameters=parameters,
+            **query_options
+        )]
+
+        # Sessions started before timestamps became epoch nanoseconds still hold ISO-8601 strings,
+        # which sort apart from numbers, so top up from those ordered by _ts
+        if len(items) < limit:
+            legacy_query = """
+            SELECT c.role, c.content, c["timestamp"] FROM c
+            WHERE c.session_id = @session_id AND c.role IN ("user", "assistant") AND IS_STRING(c["timestamp"])
+            ORDER BY c.session_id ASC, c._ts DESC
+            OFFSET 0 LIMIT @limit
+            """
+            parameters[1]["value"] = limit - len(items)
+            items += [item async for item in container.query_items(
+                query=legacy_query,
+                parameters=parameters,
+                **query_options
+            )]
+
+        # Already ordered newest first by the queries, so reversing gives chronological order
+        items.reverse()
+        debug_print(f"Retrieved {len(items)} messages from Cosmos DB for session {session_id}")
+        await fill_history_cache(session_id, items)
+        return items
+
+    except Exception as e:
+        debug_print(f"Failed to retrieve messages from Cosmos DB for session {session_id}: {str(e)}")
+        return []
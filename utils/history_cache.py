@@ -0,0 +1,91 @@
+import json
+import os
+
+from dotenv import load_dotenv
+import redis.asyncio as redis
+
+from utils.log_utils import logger, debug_print
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL")
+# Short timeouts so an unreachable Redis degrades to the Cosmos DB / per-process fallbacks instead of stalling requests
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "1"))
+HISTORY_CACHE_SIZE = 10
+HISTORY_CACHE_TTL = 3600
+
+# Initialize Redis connection pool (connections are opened lazily on first use)
+redis_client = None
+redis_enabled = False
+if REDIS_URL:
+    try:
+        redis_client = redis.Redis(connection_pool=redis.ConnectionPool.from_url(
+            REDIS_URL, socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT))
+        redis_enabled = True
+        logger.info("Redis history cache configured successfully")
+    except Exception as e:
+        logger.error(f"Redis history cache configuration failed: {str(e)}")
+else:
+    logger.info("REDIS_URL not set, history cache disabled")
+
+
+def _history_key(session_id: str):
+    return f"history:{session_id}"
+
+
+async def close_history_cache():
+    """Close the Redis connection pool, called once on app shutdown"""
+    if redis_client is not None:
+        await redis_client.aclose()
+        logger.info("Redis history cache closed")
+
+
+async def push_message_to_cache(session_id: str, message: dict):
+    """Prepend a message to the session's capped history list, if the list is already cached"""
+    if not redis_enabled:
+        return
+    try:
+        key = _history_key(session_id)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            # LPUSHX leaves a cold key missing, so the next read still falls back to Cosmos DB
+            # instead of treating a list holding only this message as the full history
+            pipe.lpushx(key, json.dumps(message))
+            pipe.ltrim(key, 0, HISTORY_CACHE_SIZE - 1)
+            pipe.expire(key, HISTORY_CACHE_TTL)
+            await pipe.execute()
+    except Exception as e:
+        debug_print(f"Failed to cache message for session {session_id}: {str(e)}")
+
+
+async def fill_history_cache(session_id: str, messages: list):
+    """Replace the session's history list with messages ordered oldest first"""
+    if not redis_enabled or not messages:
+        return
+    try:
+        key = _history_key(session_id)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            # Rebuilt atomically so entries pushed meanwhile are not duplicated behind the Cosmos DB rows;
+            # the list is kept newest first, so append from the newest message down
+            pipe.delete(key)
+            pipe.rpush(key, *[json.dumps(msg) for msg in reversed(messages)])
+            pipe.ltrim(key, 0, HISTORY_CACHE_SIZE - 1)
+            pipe.expire(key, HISTORY_CACHE_TTL)
+            await pipe.execute()
+    except Exception as e:
+        debug_print(f"Failed to fill history cache for session {session_id}: {str(e)}")
+
+
+async def get_cached_messages(session_id: str, limit: int = 5):
+    """Return the last N cached messages oldest first, or None on a cache miss"""
+    if not redis_enabled:
+        return None
+    try:
+        raw_messages = await redis_client.lrange(_history_key(session_id), 0, limit - 1)
+        if not raw_messages:
+            return None
+        messages = [json.loads(raw) for raw in raw_messages]
+        messages.reverse()
+        debug_print(f"Retrieved {len(messages)} messages from history cache for session {session_id}")
+        return messages
+    except Exception as e:
+        debug_print(f"Failed to read history cache for session {session_id}: {str(e)}")
+        return None
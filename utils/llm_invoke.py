@@ -1,10 +1,19 @@
+import ahocorasick
 import asyncio
-from openai import AzureOpenAI
+from contextlib import asynccontextmanager
+import httpx
+from openai import AsyncAzureOpenAI, APIConnectionError, InternalServerError, RateLimitError
 import os
+import random
+import tiktoken
+import time
+import uuid
 from dotenv import load_dotenv
 
-from utils.cosmos_connection import get_last_messages_from_cosmos
+from utils.cosmos_connection import get_session_messages_from_cosmos, NO_HISTORY_SESSIONS, WARMUP_SESSION_ID
+from utils.history_cache import redis_client, redis_enabled
 from utils.log_utils import debug_print
+from utils.response_cache import response_cache_key, get_cached_response, cache_response
 
 load_dotenv()
 
@@ -16,41 +25,12 @@ search_key = os.getenv("SEARCH_KEY")
 subscription_key = os.getenv("AZURE_OPENAI_API_KEY")
 Embedding_Endpoint = os.getenv("EMBEDDING_ENDPOINT")
 index_name = os.getenv("INDEX_NAME")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "25"))
+MODEL_CONTEXT = int(os.getenv("MODEL_CONTEXT", "128000"))
+MAX_RESPONSE_TOKENS = 1000
 
-
-async def warm_up_search_index():
-    """
-    Async warm up the search index with a simple query on app start
-    """
-    try:
-        debug_print("Starting search index warmup...")
-        # Make a simple query to warm up the index
-        warmup_response = await call_llm_async_with_retry("What is this document about?",
-                                                          "warmup-session",
-                                                                    max_retries=1)
-        debug_print(f"Warmup response: {warmup_response}")
-        debug_print("Search index warmed successfully")
-        return True
-    except Exception as e:
-        debug_print(f"Warmup failed: {str(e)}")
-        return False
-
-
-async def call_llm_async_with_retry(user_input: str, session_id: str, max_retries: int = 3, delay: int = 2):
-    """
-    Async call to LLM with retry logic, debug information, and Cosmos DB context
-    """
-    debug_print(f"User Query: {user_input}")
-    print("API VERSION: ",api_version)
-
-    client = AzureOpenAI(
-        azure_endpoint=endpoint,
-        api_key=subscription_key,
-        api_version=api_version,
-    )
-
-    # Enhanced prompt for better chatbot responses
-    prompt_content = """You are a helpful and knowledgeable document assistant chatbot. Your primary role is to help users find information from their documents using an integrated search system.
+# Enhanced prompt for better chatbot responses
+SYSTEM_PROMPT = """You are a helpful and knowledgeable document assistant chatbot. Your primary role is to help users find information from their documents using an integrated search system.
 
 CORE BEHAVIOR:
 - Always try to provide a helpful response, even if the information is partial
@@ -77,16 +57,277 @@ CONVERSATION FLOW:
 
 Remember: You are designed to be maximally helpful. Even when perfect information isn't available, guide the user toward useful insights or suggest ways to refine their search."""
 
-    # Build conversation context with Cosmos DB history
-    chat_prompt = [
-        {
-            "role": "system",
-            "content": f"{prompt_content}"
+# Shared across calls; each call builds its own message list around it
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Azure AI Search grounding sent with every completion
+SEARCH_DATA_SOURCES = {
+    "data_sources": [{
+        "type": "azure_search",
+        "parameters": {
+            "filter": None,
+            "endpoint": search_endpoint,
+            "index_name": index_name,
+            "semantic_configuration": "pr1semantic",
+            "authentication": {
+                "type": "api_key",
+                "key": search_key
+            },
+            "embedding_dependency": {
+                "type": "endpoint",
+                "endpoint": Embedding_Endpoint,
+                "authentication": {
+                    "type": "api_key",
+                    "key": subscription_key
+                }
+            },
+            "query_type": "semantic",   # Use simple query for better performance
+            "in_scope": True,
+            "strictness": 1,
+            "top_n_documents": 15
         }
-    ]
+    }]
+}
+
+# Shared client so the connection pool and TLS sessions are reused across requests
+client = AsyncAzureOpenAI(
+    azure_endpoint=endpoint,
+    api_key=subscription_key,
+    api_version=api_version,
+    timeout=httpx.Timeout(LLM_TIMEOUT, connect=5.0),
+    max_retries=0,
+    http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)),
+)
+
+
+def _load_encoding():
+    """Tokenizer used to size max_tokens; deployment names are not always model names"""
+    try:
+        return tiktoken.encoding_for_model(deployment)
+    except Exception:
+        pass
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        debug_print(f"Tokenizer unavailable, estimating prompt tokens from length: {str(e)}")
+        return None
 
-    # Get conversation history from Cosmos DB
-    cosmos_messages = get_last_messages_from_cosmos(session_id, limit=5)
+
+# Loaded by init_tokenizer; until then token counts fall back to a length estimate.
+# tiktoken downloads the encoding on first use unless TIKTOKEN_CACHE_DIR points at a pre-populated cache.
+_encoding = None
+_system_prompt_tokens = len(SYSTEM_PROMPT) // 4
+
+
+def _count_tokens(text: str):
+    return len(_encoding.encode(text)) if _encoding else len(text) // 4
+
+
+async def init_tokenizer():
+    """Load the tokenizer in a worker thread, called once on app startup"""
+    global _encoding, _system_prompt_tokens
+    encoding = await asyncio.to_thread(_load_encoding)
+    if encoding is not None:
+        _system_prompt_tokens = len(encoding.encode(SYSTEM_PROMPT))
+        _encoding = encoding
+
+
+def approx_prompt_tokens(messages: list):
+    """Approximate token count of a chat prompt, including per-message overhead"""
+    total = 3
+    for msg in messages:
+        # The system prompt is constant, so its count is computed once
+        total += 4 + (_system_prompt_tokens if msg is SYSTEM_MESSAGE else _count_tokens(msg["content"]))
+    return total
+
+
+# Cap concurrent LLM calls so bursts queue here instead of tripping Azure OpenAI rate limits.
+# The semaphore bounds each worker process; with Redis configured a shared limiter bounds all workers.
+LLM_INFLIGHT_LIMIT = int(os.getenv("LLM_INFLIGHT_LIMIT", "8"))
+_llm_sem = asyncio.Semaphore(LLM_INFLIGHT_LIMIT)
+llm_limiter_stats = {"limit": LLM_INFLIGHT_LIMIT, "acquired": 0, "queued": 0, "in_flight": 0}
+
+# Shared slots are ZSET members scored by lease expiry. Holders renew their lease while the call runs,
+# so a slot left behind by a crashed worker or a lost release frees itself once its lease runs out.
+LLM_INFLIGHT_KEY = "llm:inflight"
+LLM_SLOT_LEASE = 60
+LLM_SLOT_WAIT = float(os.getenv("LLM_SLOT_WAIT", "30"))
+LLM_INFLIGHT_POLL = 0.05
+
+# Atomically drops expired slots, then takes one if the limit allows
+_ACQUIRE_SLOT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+    return 1
+end
+return 0
+"""
+_acquire_slot_script = redis_client.register_script(_ACQUIRE_SLOT_SCRIPT) if redis_enabled else None
+
+
+async def _acquire_shared_slot(holder: str):
+    """
+    Take a slot from the limiter shared by all workers, waiting at most LLM_SLOT_WAIT seconds.
+    Returns False if Redis is unavailable, leaving only the per-process limit in force.
+    """
+    if not redis_enabled:
+        return False
+    deadline = time.monotonic() + LLM_SLOT_WAIT
+    while True:
+        now = time.time()
+        try:
+            acquired = await _acquire_slot_script(keys=[LLM_INFLIGHT_KEY],
+                                                  args=[now, LLM_INFLIGHT_LIMIT, now + LLM_SLOT_LEASE, holder])
+        except Exception as e:
+            debug_print(f"Shared LLM limiter unavailable, using per-process limit only: {str(e)}")
+            return False
+        if acquired:
+            return True
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Timed out after {LLM_SLOT_WAIT} seconds waiting for a shared LLM slot")
+        await asyncio.sleep(LLM_INFLIGHT_POLL + random.uniform(0, LLM_INFLIGHT_POLL))
+
+
+async def _renew_shared_slot(holder: str):
+    """Keep extending a held slot's lease so long calls and streams don't lose it"""
+    while True:
+        await asyncio.sleep(LLM_SLOT_LEASE / 3)
+        try:
+            await redis_client.zadd(LLM_INFLIGHT_KEY, {holder: time.time() + LLM_SLOT_LEASE}, xx=True)
+        except Exception as e:
+            debug_print(f"Failed to renew shared LLM limiter slot: {str(e)}")
+
+
+async def _release_shared_slot(holder: str):
+    try:
+        await redis_client.zrem(LLM_INFLIGHT_KEY, holder)
+    except Exception as e:
+        debug_print(f"Failed to release shared LLM limiter slot, it expires with its lease: {str(e)}")
+
+
+@asynccontextmanager
+async def llm_slot():
+    """Hold one of the LLM_INFLIGHT_LIMIT slots for the duration of an LLM call"""
+    holder = uuid.uuid4().hex
+    llm_limiter_stats["queued"] += 1
+    try:
+        await _llm_sem.acquire()
+        try:
+            shared_slot = await _acquire_shared_slot(holder)
+        except BaseException:
+            _llm_sem.release()
+            raise
+    finally:
+        llm_limiter_stats["queued"] -= 1
+    llm_limiter_stats["acquired"] += 1
+    llm_limiter_stats["in_flight"] += 1
+    renewer = asyncio.create_task(_renew_shared_slot(holder)) if shared_slot else None
+    try:
+        yield
+    finally:
+        llm_limiter_stats["in_flight"] -= 1
+        try:
+            if renewer is not None:
+                renewer.cancel()
+                await _release_shared_slot(holder)
+        finally:
+            # Released even if cancellation lands on the Redis release above
+            _llm_sem.release()
+
+
+# Phrases that mark a response as weak, and words that show it still carries useful content
+weak_response_phrases = [
+    "i don't know", "i do not know", "i don't have information",
+    "i cannot find", "i'm not sure", "i don't see", "no information available",
+    "i don't have access", "i cannot provide", "i'm unable to", "sorry, i don't have",
+    "i don't have any information", "i cannot help", "i'm sorry, but i don't",
+    "i don't have specific information", "i cannot locate", "i don't find"
+]
+hedge_words = ["however", "although", "but", "based on", "according to", "the document"]
+
+# Aho-Corasick automaton matching both lists in one scan of the response
+_response_automaton = ahocorasick.Automaton()
+for phrase in weak_response_phrases:
+    _response_automaton.add_word(phrase, ("weak", phrase))
+for word in hedge_words:
+    _response_automaton.add_word(word, ("hedge", word))
+_response_automaton.make_automaton()
+
+
+def check_weak_response(response_content: str):
+    """Return whether a response contains weak phrases, and whether it is genuinely weak"""
+    # Check for weak response patterns and hedging words in a single pass
+    response_lower = response_content.lower()
+    match_kinds = {kind for _, (kind, _) in _response_automaton.iter(response_lower)}
+    contains_weak_response = "weak" in match_kinds
+
+    # More sophisticated check - only retry if response is both weak AND very short
+    is_genuinely_weak = (
+            contains_weak_response and
+            len(response_content.strip()) < 150 and
+            "hedge" not in match_kinds
+    )
+    return contains_weak_response, is_genuinely_weak
+
+# Transient failures worth retrying after a backoff (APITimeoutError is an APIConnectionError)
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+# Upper bound in seconds for the backoff between retried attempts
+MAX_RETRY_BACKOFF = 30
+
+
+def retry_backoff(attempt: int, error: Exception):
+    """Seconds to wait before retrying, honouring Retry-After on rate limit errors"""
+    if isinstance(error, RateLimitError):
+        retry_after = error.response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), MAX_RETRY_BACKOFF)
+            except ValueError:
+                pass
+    return min((2 ** attempt) + random.uniform(0, 1), MAX_RETRY_BACKOFF)
+
+
+async def close_llm_client():
+    """Close the shared Azure OpenAI client, called once on app shutdown"""
+    await client.close()
+
+
+async def warm_up_search_index():
+    """
+    Async warm up the search index with a simple query on app start
+    """
+    try:
+        debug_print("Starting search index warmup...")
+        # Make a simple query to warm up the index
+        # Bypass the response cache, which would answer without touching the search index
+        warmup_response = await call_llm_async_with_retry("What is this document about?",
+                                                          WARMUP_SESSION_ID,
+                                                          max_retries=1,
+                                                          use_cache=False)
+        debug_print(f"Warmup response: {warmup_response}")
+        debug_print("Search index warmed successfully")
+        return True
+    except Exception as e:
+        debug_print(f"Warmup failed: {str(e)}")
+        return False
+
+
+async def build_chat_prompt(user_input: str, session_id: str, history: list = None):
+    """
+    Build the message list for a completion and the max_tokens it leaves room for.
+    Pass `history` when the caller already fetched the session messages to skip the lookup.
+    """
+    # Build conversation context with Cosmos DB history
+    chat_prompt = [SYSTEM_MESSAGE]
+
+    # Get conversation history from Cosmos DB unless the caller already has it or the session has none
+    cosmos_messages = history
+    if cosmos_messages is None and session_id in NO_HISTORY_SESSIONS:
+        cosmos_messages = []
+    if cosmos_messages is None:
+        cosmos_messages = await get_session_messages_from_cosmos(session_id, limit=5)
 
     if cosmos_messages:
         debug_print(f"Using Cosmos DB conversation history with {len(cosmos_messages)} messages")
@@ -102,7 +343,32 @@ Remember: You are designed to be maximally helpful. Even when perfect informatio
         "content": user_input
     })
 
-    debug_print("Chat Prompt Prepared", {"message_count": len(chat_prompt)})
+    # Only request as many completion tokens as the context window has room for
+    prompt_tokens = approx_prompt_tokens(chat_prompt)
+    max_tokens = max(1, min(MAX_RESPONSE_TOKENS, MODEL_CONTEXT - prompt_tokens))
+
+    debug_print("Chat Prompt Prepared", {"message_count": len(chat_prompt), "prompt_tokens": prompt_tokens,
+                                         "max_tokens": max_tokens})
+
+    return chat_prompt, max_tokens
+
+
+async def call_llm_async_with_retry(user_input: str, session_id: str, max_retries: int = 3, history: list = None,
+                                    use_cache: bool = True):
+    """
+    Async call to LLM with retry logic, debug information, and Cosmos DB context.
+    Pass `history` when the caller already fetched the session messages to skip the lookup,
+    and `use_cache=False` to always call the LLM without reading or writing the response cache.
+    """
+    debug_print(f"User Query: {user_input}")
+    chat_prompt, max_tokens = await build_chat_prompt(user_input, session_id, history)
+
+    # Identical prompts within the cache TTL skip the LLM entirely
+    cache_key = response_cache_key(chat_prompt) if use_cache else None
+    if use_cache:
+        cached_response = await get_cached_response(cache_key)
+        if cached_response is not None:
+            return cached_response
 
     last_response = None
     last_error = None
@@ -111,51 +377,27 @@ Remember: You are designed to be maximally helpful. Even when perfect informatio
         try:
             debug_print(f"Attempt {attempt + 1}/{max_retries}")
 
-            # Add a small delay for subsequent attempts
-            if attempt > 0:
-                debug_print(f"Waiting {delay} seconds before retry...")
-                await asyncio.sleep(delay)
-
-            # Run the completion in a thread pool to avoid blocking
-            loop = asyncio.get_event_loop()
-            completion = await loop.run_in_executor(None, lambda: client.chat.completions.create(
-                model=deployment,
-                messages=chat_prompt,
-                max_tokens=1000,
-                temperature=0.7,
-                top_p=0.95,
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=None,
-                stream=False,
-                extra_body={
-                    "data_sources": [{
-                        "type": "azure_search",
-                        "parameters": {
-                            "filter": None,
-                            "endpoint": f"{search_endpoint}",
-                            "index_name": f"{index_name}",
-                            "semantic_configuration": "pr1semantic",
-                            "authentication": {
-                                "type": "api_key",
-                                "key": f"{search_key}"
-                            },
-                            "embedding_dependency": {
-                                "type": "endpoint",
-                                "endpoint": Embedding_Endpoint,
-                                "authentication": {
-                                    "type": "api_key",
-                                    "key": subscription_key
-                                }
-                            },
-                            "query_type": "semantic",   # Use simple query for better performance
-                            "in_scope": True,
-                            "strictness": 1,
-                            "top_n_documents": 15
-                        }
-                    }]
-                }
-            ))
+            # Vary retries so they are not the same request again: raise the temperature each attempt,
+            # and let the final retry answer from general knowledge when search keeps coming back empty.
+            # last_response is only set by a genuinely weak answer, never by an error.
+            temperature = min(0.95, 0.7 + 0.1 * attempt)
+            is_final_retry = attempt > 0 and attempt == max_retries - 1
+            extra_body = None if is_final_retry and last_response is not None else SEARCH_DATA_SOURCES
+            debug_print("Attempt settings", {"temperature": temperature, "search": extra_body is not None})
+
+            async with llm_slot():
+                completion = await client.chat.completions.create(
+                    model=deployment,
+                    messages=chat_prompt,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    top_p=0.95,
+                    frequency_penalty=0,
+                    presence_penalty=0,
+                    stop=None,
+                    stream=False,
+                    extra_body=extra_body
+                )
 
             # Debug: Log the full completion response
             debug_print("Full OpenAI Response", {
@@ -174,25 +416,7 @@ Remember: You are designed to be maximally helpful. Even when perfect informatio
             if hasattr(choice.message, 'context'):
                 debug_print("AI Search Context Found", choice.message.context)
 
-            # Check for weak response patterns
-            weak_response_phrases = [
-                "i don't know", "i do not know", "i don't have information",
-                "i cannot find", "i'm not sure", "i don't see", "no information available",
-                "i don't have access", "i cannot provide", "i'm unable to", "sorry, i don't have",
-                "i don't have any information", "i cannot help", "i'm sorry, but i don't",
-                "i don't have specific information", "i cannot locate", "i don't find"
-            ]
-
-            response_lower = response_content.lower()
-            contains_weak_response = any(phrase in response_lower for phrase in weak_response_phrases)
-
-            # More sophisticated check - only retry if response is both weak AND very short
-            is_genuinely_weak = (
-                    contains_weak_response and
-                    len(response_content.strip()) < 150 and
-                    not any(word in response_lower for word in
-                            ["however", "although", "but", "based on", "according to", "the document"])
-            )
+            contains_weak_response, is_genuinely_weak = check_weak_response(response_content)
 
             debug_print(f"Contains weak response phrases: {contains_weak_response}")
             debug_print(f"Is genuinely weak response: {is_genuinely_weak}")
@@ -205,8 +429,23 @@ Remember: You are designed to be maximally helpful. Even when perfect informatio
                 continue
             else:
                 debug_print("Returning final response")
+                # Answers given without search grounding are not cached under the grounded prompt's key
+                if use_cache and not is_genuinely_weak and extra_body is not None:
+                    await cache_response(cache_key, response_content)
                 return response_content
 
+        except RETRYABLE_ERRORS as e:
+            last_error = e
+            debug_print(f"Transient error in attempt {attempt + 1}: {str(e)}")
+            if attempt < max_retries - 1:
+                backoff = retry_backoff(attempt, e)
+                debug_print(f"Waiting {backoff:.2f} seconds before retry...")
+                await asyncio.sleep(backoff)
+                continue
+            else:
+                debug_print("Max retries reached, raising error")
+                raise e
+
         except Exception as e:
             last_error = e
             debug_print(f"Error in attempt {attempt + 1}: {str(e)}")
@@ -225,3 +464,64 @@ Remember: You are designed to be maximally helpful. Even when perfect informatio
         debug_print("Raising last error after all retries")
         raise last_error
     return None
+
+
+async def stream_llm_response(user_input: str, session_id: str, max_retries: int = 3, history: list = None):
+    """
+    Async generator yielding the LLM response text as it streams in.
+    Transient errors (throttling, timeouts, connection errors, 5xx) are retried until the stream opens;
+    weak responses are not retried since the text has already been sent on.
+    """
+    debug_print(f"User Query (streaming): {user_input}")
+    chat_prompt, max_tokens = await build_chat_prompt(user_input, session_id, history)
+
+    cache_key = response_cache_key(chat_prompt)
+    cached_response = await get_cached_response(cache_key)
+    if cached_response is not None:
+        yield cached_response
+        return
+
+    for attempt in range(max_retries):
+        async with llm_slot():
+            try:
+                completion = await client.chat.completions.create(
+                    model=deployment,
+                    messages=chat_prompt,
+                    max_tokens=max_tokens,
+                    temperature=0.7,
+                    top_p=0.95,
+                    frequency_penalty=0,
+                    presence_penalty=0,
+                    stop=None,
+                    stream=True,
+                    extra_body=SEARCH_DATA_SOURCES
+                )
+            except RETRYABLE_ERRORS as e:
+                debug_print(f"Transient error opening stream in attempt {attempt + 1}: {str(e)}")
+                if attempt == max_retries - 1:
+                    raise e
+                backoff = retry_backoff(attempt, e)
+            else:
+                parts = []
+                try:
+                    async for chunk in completion:
+                        # Azure sends content filter results in chunks without choices
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            parts.append(delta)
+                            yield delta
+                finally:
+                    # Release the connection right away if the consumer stops early (e.g. client disconnect)
+                    await completion.close()
+                # Cache like the buffered path does, so a weak answer never masks its retry in /chat/sync
+                response_content = "".join(parts)
+                _, is_genuinely_weak = check_weak_response(response_content)
+                if not is_genuinely_weak:
+                    await cache_response(cache_key, response_content)
+                return
+
+        # Back off outside the limiter so the slot is free while waiting
+        debug_print(f"Waiting {backoff:.2f} seconds before retry...")
+        await asyncio.sleep(backoff)
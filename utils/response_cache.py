@@ -0,0 +1,38 @@
+import hashlib
+import json
+
+from utils.history_cache import redis_client, redis_enabled
+from utils.log_utils import debug_print
+
+RESPONSE_CACHE_TTL = 300
+
+
+def response_cache_key(chat_prompt: list):
+    """Cache key for a full chat prompt (system prompt, history and user input)"""
+    digest = hashlib.blake2b(json.dumps(chat_prompt).encode(), digest_size=16).hexdigest()
+    return f"llm:{digest}"
+
+
+async def get_cached_response(key: str):
+    """Return the cached LLM response for a prompt key, or None on a miss"""
+    if not redis_enabled:
+        return None
+    try:
+        cached = await redis_client.get(key)
+        if cached is None:
+            return None
+        debug_print(f"LLM response cache hit for {key}")
+        return cached.decode()
+    except Exception as e:
+        debug_print(f"Failed to read LLM response cache: {str(e)}")
+        return None
+
+
+async def cache_response(key: str, response: str):
+    """Cache an LLM response for RESPONSE_CACHE_TTL seconds"""
+    if not redis_enabled or not response:
+        return
+    try:
+        await redis_client.set(key, response, ex=RESPONSE_CACHE_TTL)
+    except Exception as e:
+        debug_print(f"Failed to write LLM response cache: {str(e)}")